@@ -1,19 +1,25 @@
-from collections import defaultdict
-from lxml import etree, objectify
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from io import BytesIO
+import re
+from xml.sax.saxutils import escape
+from lxml import etree
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth1
 from requests_oauthlib.oauth1_auth import SIGNATURE_TYPE_AUTH_HEADER
 from requests.structures import CaseInsensitiveDict
 
-from .outcome_response import OutcomeResponse
+from .outcome_response import (OutcomeResponse, LTI_NAMESPACE, NS,
+                               PARSER_OPTIONS)
 from .utils import InvalidLTIConfigError
 
 REPLACE_REQUEST = 'replaceResult'
 DELETE_REQUEST = 'deleteResult'
 READ_REQUEST = 'readResult'
 
-VALID_ATTRIBUTES = [
+VALID_ATTRIBUTES = frozenset([
     'operation',
     'score',
     'result_data',
@@ -25,7 +31,237 @@ VALID_ATTRIBUTES = [
     'consumer_secret',
     'post_request',
     'needs_additional_review'
-]
+])
+
+# The pool is sized so that concurrent grade posts to a single Tool Consumer
+# keep their connections alive rather than discarding them on return.
+POOL_MAXSIZE = 20
+
+# The result_data keys Canvas accepts, in the order they take precedence
+_RESULT_DATA_KEYS_ORDER = ('text', 'url', 'ltiLaunchUrl')
+_RESULT_DATA_KEYS = frozenset(_RESULT_DATA_KEYS_ORDER)
+
+# Attributes that generate_request_xml reads; assigning any of them
+# discards the cached request XML.
+_XML_ATTRIBUTES = frozenset([
+    'operation',
+    'score',
+    'result_data',
+    'message_identifier',
+    'lis_result_sourcedid',
+    'needs_additional_review'
+])
+
+_DEFAULT_HEADERS = CaseInsensitiveDict({'Content-Type': 'application/xml'})
+
+# Shared across requests so that grade passback to the same Tool Consumer
+# reuses pooled keep-alive connections instead of a new TLS handshake.
+_SESSION = requests.Session()
+for _prefix in ('https://', 'http://'):
+    _SESSION.mount(_prefix, HTTPAdapter(pool_maxsize=POOL_MAXSIZE))
+
+_OPERATION_TAG = {
+    REPLACE_REQUEST: 'replaceResultRequest',
+    DELETE_REQUEST: 'deleteResultRequest',
+    READ_REQUEST: 'readResultRequest',
+}
+
+
+def _tag(name):
+    return '{%s}%s' % (LTI_NAMESPACE, name)
+
+
+_MESSAGE_IDENTIFIER_TAG = _tag('imsx_messageIdentifier')
+_REPLACE_REQUEST_TAG = _tag(_OPERATION_TAG[REPLACE_REQUEST])
+_DELETE_REQUEST_TAG = _tag(_OPERATION_TAG[DELETE_REQUEST])
+_READ_REQUEST_TAG = _tag(_OPERATION_TAG[READ_REQUEST])
+_RESULT_DATA_KEY_BY_TAG = dict(
+    (_tag(key), key) for key in _RESULT_DATA_KEYS_ORDER)
+_NEEDS_ADDITIONAL_REVIEW_PATH = '%s/%s' % (_tag('submissionDetails'),
+                                           _tag('needsAdditionalReview'))
+
+# Paths relative to the operation element, compiled once at import. Plain
+# strings are returned so that results don't keep the parsed tree alive.
+_XP_SOURCEDID = etree.XPath(
+    'ims:resultRecord/ims:sourcedGUID/ims:sourcedId/text()',
+    namespaces=NS, smart_strings=False)
+_XP_SCORE = etree.XPath(
+    'ims:resultRecord/ims:result/ims:resultScore/ims:textString/text()',
+    namespaces=NS, smart_strings=False)
+_XP_RESULT_DATA = etree.XPath(
+    'ims:resultRecord/ims:result/ims:resultData/*', namespaces=NS)
+
+
+def _make_oauth1(consumer_key, consumer_secret, **kwargs):
+    return OAuth1(consumer_key, consumer_secret,
+                  signature_type=SIGNATURE_TYPE_AUTH_HEADER,
+                  force_include_body=True, **kwargs)
+
+
+# The nonce and timestamp are generated each time a request is signed, so a
+# signer without extra options can be shared by every request that uses the
+# same credentials.
+_get_oauth1 = lru_cache(maxsize=32)(_make_oauth1)
+
+
+# Outgoing requests are a small, fixed-shape document, so they are rendered
+# from string templates rather than built up as an element tree. The output
+# is byte-for-byte what lxml would serialize for the same tree (compact,
+# with empty elements self-closed), which keeps OAuth body hashes stable.
+# Characters that cannot appear in an XML 1.0 document
+_INVALID_XML_CHARS = re.compile(
+    '[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+_INVALID_XML_MESSAGE = ('All strings must be XML compatible: Unicode or '
+                        'ASCII, no NULL bytes or control characters')
+_XML_DECLARATION = b"<?xml version='1.0' encoding='utf-8'?>\n"
+_REQUEST_TEMPLATE = (
+    '<imsx_POXEnvelopeRequest xmlns="%(namespace)s">'
+    '<imsx_POXHeader><imsx_POXRequestHeaderInfo>'
+    '<imsx_version>V1.0</imsx_version>%(message_identifier)s'
+    '</imsx_POXRequestHeaderInfo></imsx_POXHeader>'
+    '<imsx_POXBody><%(request_tag)s>'
+    '<resultRecord>%(record)s</resultRecord>%(submission_details)s'
+    '</%(request_tag)s></imsx_POXBody>'
+    '</imsx_POXEnvelopeRequest>'
+)
+_RESULT_SCORE_TEMPLATE = (
+    '<resultScore><language>en</language>'
+    '<textString>%s</textString></resultScore>'
+)
+_SUBMISSION_DETAILS = (
+    '<submissionDetails><needsAdditionalReview/></submissionDetails>'
+)
+
+
+def _escape(text):
+    if text is None:
+        return None
+    # Same checks lxml applies when setting element text: bytes must be
+    # ASCII, and no string may contain characters illegal in XML.
+    if isinstance(text, bytes):
+        try:
+            text = text.decode('ascii')
+        except UnicodeDecodeError:
+            raise ValueError(_INVALID_XML_MESSAGE)
+    if _INVALID_XML_CHARS.search(text):
+        raise ValueError(_INVALID_XML_MESSAGE)
+    return escape(text, {'\r': '&#13;'})
+
+
+def _element(tag, content):
+    if content is None:
+        return '<%s/>' % tag
+    return '<%s>%s</%s>' % (tag, content, tag)
+
+
+def _render_request(request_tag, message_identifier, sourcedid, result='',
+                    submission_details=''):
+    record = _element('sourcedGUID',
+                      _element('sourcedId', _escape(sourcedid)))
+    if result:
+        record += _element('result', result)
+
+    return (_REQUEST_TEMPLATE % {
+        'namespace': LTI_NAMESPACE,
+        'message_identifier': _element('imsx_messageIdentifier',
+                                       _escape(message_identifier)),
+        'request_tag': request_tag,
+        'record': record,
+        'submission_details': submission_details,
+    }).encode('utf-8')
+
+
+def _build_result_xml(request_tag, message_identifier, sourcedid, score,
+                      result_data, needs_additional_review):
+    result = ''
+    if score is not None:
+        result += _RESULT_SCORE_TEMPLATE % _escape(str(score))
+
+    if result_data:
+        for key in _RESULT_DATA_KEYS_ORDER:
+            if key in result_data:
+                result += _element('resultData', _element(
+                    key, _escape(result_data[key])))
+                break
+
+    # Canvas needsAdditionalReview extension:
+    # https://github.com/instructure/canvas-lms/blob/master/doc/api/assignment_tools.md#submission-needs-additional-review
+    submission_details = ''
+    if needs_additional_review:
+        submission_details = _SUBMISSION_DETAILS
+
+    return _render_request(request_tag, message_identifier, sourcedid,
+                           result, submission_details)
+
+
+def _build_identify_xml(request_tag, message_identifier, sourcedid, score,
+                        result_data, needs_additional_review):
+    return _render_request(request_tag, message_identifier, sourcedid)
+
+
+# deleteResult and readResult only identify a result, so their builders
+# skip the score, result data and review flag entirely. Operations not
+# listed here render everything that is set.
+_BUILDERS = {
+    REPLACE_REQUEST: partial(_build_result_xml,
+                             _OPERATION_TAG[REPLACE_REQUEST]),
+    DELETE_REQUEST: partial(_build_identify_xml,
+                            _OPERATION_TAG[DELETE_REQUEST]),
+    READ_REQUEST: partial(_build_identify_xml,
+                          _OPERATION_TAG[READ_REQUEST]),
+}
+
+
+def _parse_message_identifier(request, elem):
+    request.message_identifier = elem.text or ''
+
+
+def _text(nodes):
+    if not nodes:
+        return None
+    return nodes[0]
+
+
+def _result_data(nodes):
+    values = dict((_RESULT_DATA_KEY_BY_TAG.get(node.tag), node.text)
+                  for node in nodes)
+    for key in _RESULT_DATA_KEYS_ORDER:
+        if key in values:
+            return {key: values[key]}
+    return None
+
+
+def _parse_replace_request(request, elem):
+    request.operation = REPLACE_REQUEST
+    request.lis_result_sourcedid = _text(_XP_SOURCEDID(elem))
+    request.score = _text(_XP_SCORE(elem))
+    result_data = _result_data(_XP_RESULT_DATA(elem))
+    if result_data is not None:
+        request.result_data = result_data
+    # The result record and the Canvas needsAdditionalReview extension have
+    # no handlers of their own, so they are still attached at this point.
+    request.needs_additional_review = \
+        elem.find(_NEEDS_ADDITIONAL_REVIEW_PATH) is not None
+
+
+def _parse_delete_request(request, elem):
+    request.operation = DELETE_REQUEST
+    request.lis_result_sourcedid = _text(_XP_SOURCEDID(elem))
+
+
+def _parse_read_request(request, elem):
+    request.operation = READ_REQUEST
+    request.lis_result_sourcedid = _text(_XP_SOURCEDID(elem))
+
+
+# Elements are dispatched on their fully-qualified tag as soon as they are
+# closed, so the document is walked exactly once.
+_PARSE_HANDLERS = {
+    _MESSAGE_IDENTIFIER_TAG: _parse_message_identifier,
+    _REPLACE_REQUEST_TAG: _parse_replace_request,
+    _DELETE_REQUEST_TAG: _parse_delete_request,
+    _READ_REQUEST_TAG: _parse_read_request,
+}
 
 
 class OutcomeRequest(object):
@@ -38,24 +274,44 @@ class OutcomeRequest(object):
     This class can be used both by Tool Providers and Tool Consumers, though
     they each use it differently. The TP will use it to POST an OAuth-signed
     request to the TC. A TC will use it to parse such a request from a TP.
+
+    Outgoing requests are sent through ``session``, a ``requests.Session``
+    shared by all instances. Assign a different session to the class or to
+    an instance to control connection pooling.
+
+    Request XML is sent without whitespace between elements. Set
+    ``xml_declaration`` to False, on the class or on an instance, to also
+    leave out the XML declaration for Tool Consumers that don't require it.
     '''
-    def __init__(self, opts=defaultdict(lambda: None), headers=None):
-        # Initialize all our accessors to None
+    session = _SESSION
+    xml_declaration = True
+    _request_xml = None
+
+    def __init__(self, opts=None, headers=None):
+        if opts is None:
+            opts = {}
+
+        invalid = opts.keys() - VALID_ATTRIBUTES
+        if invalid:
+            raise InvalidLTIConfigError(
+                "Invalid outcome request option: {}".format(
+                    ', '.join(sorted(invalid)))
+            )
+
+        # Store specified options in our accessors, defaulting to None
         for attr in VALID_ATTRIBUTES:
-            setattr(self, attr, None)
+            setattr(self, attr, opts.get(attr))
 
-        # Store specified options in our accessors
-        for (key, val) in opts.items():
-            if key in VALID_ATTRIBUTES:
-                setattr(self, key, val)
-            else:
-                raise InvalidLTIConfigError(
-                    "Invalid outcome request option: {}".format(key)
-                )
+        if headers is None:
+            self.headers = _DEFAULT_HEADERS.copy()
+        else:
+            self.headers = CaseInsensitiveDict(_DEFAULT_HEADERS)
+            self.headers.update(headers)
 
-        self.headers = CaseInsensitiveDict(headers or {})
-        if "Content-Type" not in self.headers:
-            self.headers['Content-type'] = 'application/xml'
+    def __setattr__(self, key, value):
+        if key in _XML_ATTRIBUTES:
+            self.__dict__['_request_xml'] = None
+        object.__setattr__(self, key, value)
 
     @staticmethod
     def from_post_request(post_request, headers=None):
@@ -70,6 +326,35 @@ class OutcomeRequest(object):
         request.process_xml(post_request.body)
         return request
 
+    @classmethod
+    def post_batch(cls, outcome_requests, max_workers=POOL_MAXSIZE):
+        '''
+        POST several prepared outcome requests to their Tool Consumers
+        concurrently.
+
+        LTI 1.1 allows only one result per request, but each OutcomeRequest
+        is independent, so they can be in flight at the same time. Each
+        request must already have its operation set (and its score, for a
+        replaceResult). Returns the OutcomeResponse objects in the same
+        order as the requests.
+
+        The shared session keeps at most POOL_MAXSIZE connections per host.
+        Connections opened beyond that are closed after use instead of being
+        reused, so max_workers should not exceed the pool size of the
+        session the requests use. Give them a session with a larger
+        HTTPAdapter pool to run more workers.
+
+        If a post raises, its exception is re-raised from here and none of
+        the responses are returned. Requests that had not started by then
+        are cancelled. Requests that completed keep their response in
+        outcome_response, so check each request's outcome_response to see
+        which ones were posted.
+        '''
+        with ThreadPoolExecutor(max_workers) as executor:
+            return list(executor.map(
+                lambda request: request.post_outcome_request(),
+                outcome_requests))
+
     def post_replace_result(self, score, result_data=None, needs_additional_review=False):
         '''
         POSTs the given score to the Tool Consumer with a replaceResult.
@@ -92,7 +377,7 @@ class OutcomeRequest(object):
                 error_msg = ('Dictionary result_data can only have one entry. '
                              '{0} entries were found.'.format(len(result_data)))
                 raise InvalidLTIConfigError(error_msg)
-            elif 'text' not in result_data and 'url' not in result_data and 'ltiLaunchUrl' not in result_data:
+            elif not (result_data.keys() & _RESULT_DATA_KEYS):
                 error_msg = ('Dictionary result_data can only have the key '
                              '"text" or the key "url" or the key "ltiLaunchUrl".')
                 raise InvalidLTIConfigError(error_msg)
@@ -144,13 +429,17 @@ class OutcomeRequest(object):
             raise InvalidLTIConfigError(
                 'OutcomeRequest does not have all required attributes')
 
-        header_oauth = OAuth1(self.consumer_key, self.consumer_secret,
-                              signature_type=SIGNATURE_TYPE_AUTH_HEADER,
-                              force_include_body=True, **kwargs)
+        if kwargs:
+            header_oauth = _make_oauth1(self.consumer_key,
+                                        self.consumer_secret, **kwargs)
+        else:
+            header_oauth = _get_oauth1(self.consumer_key,
+                                       self.consumer_secret)
 
-        resp = requests.post(self.lis_outcome_service_url, auth=header_oauth,
-                             data=self.generate_request_xml(),
-                             headers=self.headers)
+        resp = self.session.post(self.lis_outcome_service_url,
+                                 auth=header_oauth,
+                                 data=self.generate_request_xml(),
+                                 headers=self.headers)
         outcome_resp = OutcomeResponse.from_post_response(resp, resp.content)
         self.outcome_response = outcome_resp
         return self.outcome_response
@@ -158,49 +447,19 @@ class OutcomeRequest(object):
     def process_xml(self, xml):
         '''
         Parse Outcome Request data from XML.
-        '''
-        root = objectify.fromstring(xml)
-        self.message_identifier = str(
-            root.imsx_POXHeader.imsx_POXRequestHeaderInfo.
-            imsx_messageIdentifier)
-        try:
-            result = root.imsx_POXBody.replaceResultRequest
-            self.operation = REPLACE_REQUEST
-            # Get result sourced id from resultRecord
-            self.lis_result_sourcedid = result.resultRecord.\
-                sourcedGUID.sourcedId
-            self.score = str(result.resultRecord.result.
-                             resultScore.textString)
-
-            if len(resultData := result.find('resultRecord/result/resultData', root.nsmap)):
-                if r := resultData.find('text', root.nsmap):
-                    self.result_data = {'text': result}
-                elif r := resultData.find('url', root.nsmap):
-                    self.result_data = {'url': result}
-                elif r := resultData.find('ltiLaunchUrl', root.nsmap):
-                    self.result_data = {'ltiLaunchUrl': r}
-
-            self.needs_additional_review = result.find('submissionDetails/needsAdditionalReview', root.nsmap) is not None
-        except:
-            pass
 
-        try:
-            result = root.imsx_POXBody.deleteResultRequest
-            self.operation = DELETE_REQUEST
-            # Get result sourced id from resultRecord
-            self.lis_result_sourcedid = result.resultRecord.\
-                sourcedGUID.sourcedId
-        except:
-            pass
-
-        try:
-            result = root.imsx_POXBody.readResultRequest
-            self.operation = READ_REQUEST
-            # Get result sourced id from resultRecord
-            self.lis_result_sourcedid = result.resultRecord.\
-                sourcedGUID.sourcedId
-        except:
-            pass
+        xml may be a bytes object or a file-like object, which is parsed
+        incrementally as it is read.
+        '''
+        if isinstance(xml, str):
+            xml = xml.encode('utf-8')
+        if not hasattr(xml, 'read'):
+            xml = BytesIO(xml)
+        for _, elem in etree.iterparse(xml, events=('end',), **PARSER_OPTIONS):
+            handler = _PARSE_HANDLERS.get(elem.tag)
+            if handler is not None:
+                handler(self, elem)
+                elem.clear()
 
     def has_required_attributes(self):
         return self.consumer_key is not None\
@@ -210,51 +469,25 @@ class OutcomeRequest(object):
             and self.operation is not None
 
     def generate_request_xml(self):
-        root = etree.Element(
-            'imsx_POXEnvelopeRequest',
-            xmlns='http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0')
-
-        header = etree.SubElement(root, 'imsx_POXHeader')
-        header_info = etree.SubElement(header, 'imsx_POXRequestHeaderInfo')
-        version = etree.SubElement(header_info, 'imsx_version')
-        version.text = 'V1.0'
-        message_identifier = etree.SubElement(header_info,
-                                              'imsx_messageIdentifier')
-        message_identifier.text = self.message_identifier
-        body = etree.SubElement(root, 'imsx_POXBody')
-        request = etree.SubElement(body, '%s%s' % (self.operation,
-                                                   'Request'))
-        record = etree.SubElement(request, 'resultRecord')
-
-        guid = etree.SubElement(record, 'sourcedGUID')
-
-        sourcedid = etree.SubElement(guid, 'sourcedId')
-        sourcedid.text = self.lis_result_sourcedid
-
-        if self.score is not None:
-            result = etree.SubElement(record, 'result')
-            result_score = etree.SubElement(result, 'resultScore')
-            language = etree.SubElement(result_score, 'language')
-            language.text = 'en'
-            text_string = etree.SubElement(result_score, 'textString')
-            text_string.text = self.score.__str__()
-
-        if self.result_data:
-            resultData = etree.SubElement(result, 'resultData')
-            if 'text' in self.result_data:
-                resultDataText = etree.SubElement(resultData, 'text')
-                resultDataText.text = self.result_data['text']
-            elif 'url' in self.result_data:
-                resultDataURL = etree.SubElement(resultData, 'url')
-                resultDataURL.text = self.result_data['url']
-            elif 'ltiLaunchUrl' in self.result_data:
-                resultDataLaunchURL = etree.SubElement(resultData, 'ltiLaunchUrl')
-                resultDataLaunchURL.text = self.result_data['ltiLaunchUrl']
-
-        # Canvas needsAdditionalReview extension:
-        # https://github.com/instructure/canvas-lms/blob/master/doc/api/assignment_tools.md#submission-needs-additional-review
-        if self.needs_additional_review:
-            submissionDetails = etree.SubElement(request, 'submissionDetails')
-            etree.SubElement(submissionDetails, 'needsAdditionalReview')
-
-        return etree.tostring(root, xml_declaration=True, encoding='utf-8')
+        '''
+        Generate the request XML for the current configuration.
+
+        The result is reused until one of the attributes it is built from is
+        reassigned, so a retried request is not rendered again. Mutating
+        result_data in place does not invalidate it.
+        '''
+        if self._request_xml is None:
+            self._request_xml = self._render_request_xml()
+        # Checked on every call so that changing xml_declaration on the
+        # class also applies to requests that were already rendered
+        if self.xml_declaration:
+            return _XML_DECLARATION + self._request_xml
+        return self._request_xml
+
+    def _render_request_xml(self):
+        builder = _BUILDERS.get(self.operation)
+        if builder is None:
+            builder = partial(_build_result_xml, '%sRequest' % self.operation)
+        return builder(self.message_identifier, self.lis_result_sourcedid,
+                       self.score, self.result_data,
+                       self.needs_additional_review)
@@ -1,4 +1,4 @@
-from lxml import etree, objectify
+from lxml import etree
 from .utils import InvalidLTIConfigError
 
 CODE_MAJOR_CODES = [
@@ -14,7 +14,7 @@ SEVERITY_CODES = [
     'error'
 ]
 
-VALID_ATTRIBUTES = [
+VALID_ATTRIBUTES = frozenset([
     'request_type',
     'score',
     'message_identifier',
@@ -25,7 +25,60 @@ VALID_ATTRIBUTES = [
     'description',
     'operation',
     'message_ref_identifier'
-]
+])
+
+LTI_NAMESPACE = 'http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0'
+
+NS = {'ims': LTI_NAMESPACE}
+
+# Outcome XML never needs entities, comments, processing instructions or
+# IDs. Leaving entity resolution off also keeps external entities (XXE) out
+# of parsing.
+PARSER_OPTIONS = {
+    'remove_blank_text': True,
+    'remove_comments': True,
+    'remove_pis': True,
+    'collect_ids': False,
+    'resolve_entities': False,
+    'huge_tree': False,
+}
+
+# Bytes handed to the parser at a time when reading a stream
+STREAM_CHUNK_SIZE = 8192
+
+# Compiled once so that parsing a response doesn't re-resolve each path and
+# its namespace prefixes. Header paths are relative to imsx_POXHeader.
+_HEADER_INFO_PATH = 'ims:imsx_POXResponseHeaderInfo'
+_XP_MESSAGE_IDENTIFIER = etree.XPath(
+    _HEADER_INFO_PATH + '/ims:imsx_messageIdentifier', namespaces=NS)
+_XP_STATUS_INFO = etree.XPath(
+    _HEADER_INFO_PATH + '/ims:imsx_statusInfo', namespaces=NS)
+_XP_CODE_MAJOR = etree.XPath('ims:imsx_codeMajor', namespaces=NS)
+_XP_SEVERITY = etree.XPath('ims:imsx_severity', namespaces=NS)
+_XP_DESCRIPTION = etree.XPath('ims:imsx_description', namespaces=NS)
+_XP_MESSAGE_REF_IDENTIFIER = etree.XPath(
+    'ims:imsx_messageRefIdentifier', namespaces=NS)
+_XP_OPERATION_REF_IDENTIFIER = etree.XPath(
+    'ims:imsx_operationRefIdentifier', namespaces=NS)
+_XP_SCORE = etree.XPath('ims:result/ims:resultScore/ims:textString',
+                        namespaces=NS)
+
+_OPERATION_TAG = {
+    'replaceResult': 'replaceResultResponse',
+    'deleteResult': 'deleteResultResponse',
+    'readResult': 'readResultResponse',
+}
+
+_HEADER_TAG = '{%s}imsx_POXHeader' % LTI_NAMESPACE
+_BODY_TAG = '{%s}imsx_POXBody' % LTI_NAMESPACE
+_READ_RESULT_RESPONSE_TAG = '{%s}%s' % (LTI_NAMESPACE,
+                                        _OPERATION_TAG['readResult'])
+
+
+def _first(nodes):
+    if not nodes:
+        return None
+    return nodes[0].text or ''
 
 
 class OutcomeResponse(object):
@@ -44,18 +97,16 @@ class OutcomeResponse(object):
     to send back to a TP.
     '''
     def __init__(self, **kwargs):
-        # Initialize all class accessors to None
-        for attr in VALID_ATTRIBUTES:
-            setattr(self, attr, None)
+        invalid = kwargs.keys() - VALID_ATTRIBUTES
+        if invalid:
+            raise InvalidLTIConfigError(
+                "Invalid outcome response option: {}".format(
+                    ', '.join(sorted(invalid)))
+            )
 
-        # Store specified options in our options member
-        for (key, val) in kwargs.items():
-            if key in VALID_ATTRIBUTES:
-                setattr(self, key, val)
-            else:
-                raise InvalidLTIConfigError(
-                    "Invalid outcome response option: {}".format(key)
-                )
+        # Store specified options in our accessors, defaulting to None
+        for attr in VALID_ATTRIBUTES:
+            setattr(self, attr, kwargs.get(attr))
 
     @staticmethod
     def from_post_response(post_response, content):
@@ -69,6 +120,25 @@ class OutcomeResponse(object):
         response.process_xml(content)
         return response
 
+    @staticmethod
+    def from_stream(post_response):
+        '''
+        Convenience method for creating a new OutcomeResponse from a
+        response object that was requested with stream=True.
+
+        The body is parsed chunk by chunk as it is received and is not kept,
+        so memory stays bounded by the largest header or operation element.
+        As a consequence post_response.content is not available afterwards;
+        use from_post_response when the body is needed.
+        '''
+        response = OutcomeResponse()
+        response.post_response = post_response
+        response.response_code = post_response.status_code
+        # iter_content decodes any Content-Encoding and raises requests
+        # exceptions for network errors, as reading .content would.
+        response._process_chunks(post_response.iter_content(STREAM_CHUNK_SIZE))
+        return response
+
     def is_success(self):
         return self.code_major == 'success'
 
@@ -90,35 +160,62 @@ class OutcomeResponse(object):
     def process_xml(self, xml):
         '''
         Parse OutcomeResponse data form XML.
+
+        xml may be a bytes object or a file-like object, which is parsed
+        incrementally as it is read.
         '''
+        if isinstance(xml, str):
+            xml = xml.encode('utf-8')
+        if hasattr(xml, 'read'):
+            chunks = iter(lambda: xml.read(STREAM_CHUNK_SIZE), b'')
+        else:
+            chunks = [xml]
+        self._process_chunks(chunks)
+
+    def _process_chunks(self, chunks):
+        parser = etree.XMLPullParser(events=('end',), **PARSER_OPTIONS)
         try:
-            root = objectify.fromstring(xml)
-            # Get message idenifier from header info
-            self.message_identifier = root.imsx_POXHeader.\
-                imsx_POXResponseHeaderInfo.\
-                imsx_messageIdentifier
+            for chunk in chunks:
+                parser.feed(chunk)
+                self._process_events(parser.read_events())
+            parser.close()
+            self._process_events(parser.read_events())
+        except etree.XMLSyntaxError:
+            # Not an outcome response (e.g. an HTML error page)
+            pass
 
-            status_node = root.imsx_POXHeader.\
-                imsx_POXResponseHeaderInfo.\
-                imsx_statusInfo
+    def _process_events(self, events):
+        # The header and each operation in the body are handled and
+        # discarded as soon as they are closed.
+        for _, elem in events:
+            if elem.tag == _HEADER_TAG:
+                self._process_header(elem)
+                elem.clear()
+            else:
+                parent = elem.getparent()
+                if parent is not None and parent.tag == _BODY_TAG:
+                    self._process_operation(elem)
+                    elem.clear()
 
+    def _process_header(self, header):
+        # Get message idenifier from header info
+        self.message_identifier = _first(_XP_MESSAGE_IDENTIFIER(header))
+
+        status_info = _XP_STATUS_INFO(header)
+        if status_info:
+            status_node = status_info[0]
             # Get status parameters from header info status
-            self.code_major = status_node.imsx_codeMajor
-            self.severity = status_node.imsx_severity
-            self.description = status_node.imsx_description
-            self.message_ref_identifier = str(
-                status_node.imsx_messageRefIdentifier)
-            self.operation = status_node.imsx_operationRefIdentifier
-
-            try:
-                # Try to get the score
-                self.score = str(root.imsx_POXBody.readResultResponse.
-                                 result.resultScore.textString)
-            except AttributeError:
-                # Not a readResult, just ignore!
-                pass
-        except:
-            pass
+            self.code_major = _first(_XP_CODE_MAJOR(status_node))
+            self.severity = _first(_XP_SEVERITY(status_node))
+            self.description = _first(_XP_DESCRIPTION(status_node))
+            self.message_ref_identifier = _first(
+                _XP_MESSAGE_REF_IDENTIFIER(status_node))
+            self.operation = _first(_XP_OPERATION_REF_IDENTIFIER(status_node))
+
+    def _process_operation(self, operation):
+        # Only a readResult response carries a score
+        if operation.tag == _READ_RESULT_RESPONSE_TAG:
+            self.score = _first(_XP_SCORE(operation))
 
     def generate_response_xml(self):
         '''
@@ -126,7 +223,7 @@ class OutcomeResponse(object):
         '''
         root = etree.Element(
             'imsx_POXEnvelopeResponse',
-            xmlns='http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0')
+            xmlns=LTI_NAMESPACE)
 
         header = etree.SubElement(root, 'imsx_POXHeader')
         header_info = etree.SubElement(header, 'imsx_POXResponseHeaderInfo')
@@ -152,8 +249,10 @@ class OutcomeResponse(object):
         operation_ref_identifier.text = str(self.operation)
 
         body = etree.SubElement(root, 'imsx_POXBody')
-        response = etree.SubElement(body, '%s%s' % (self.operation,
-                                                    'Response'))
+        response_tag = _OPERATION_TAG.get(self.operation)
+        if response_tag is None:
+            response_tag = '%sResponse' % self.operation
+        response = etree.SubElement(body, response_tag)
 
         if self.score:
             result = etree.SubElement(response, 'result')
@@ -7,7 +7,6 @@ from oauthlib.oauth1.rfc5849 import CONTENT_TYPE_FORM_URLENCODED
 from requests.structures import CaseInsensitiveDict
 
 from .outcome_request import OutcomeRequest
-from collections import defaultdict
 
 try:
     from urllib.parse import urlencode, urlsplit, urlunsplit, parse_qsl
@@ -114,7 +113,7 @@ class ToolProvider(ToolBase):
             original.fragment
         ))
 
-    def post_replace_result(self, score, outcome_opts=defaultdict(lambda: None), result_data=None):
+    def post_replace_result(self, score, outcome_opts=None, result_data=None):
         '''
         POSTs the given score to the Tool Consumer with a replaceResult.
 
@@ -130,13 +129,13 @@ class ToolProvider(ToolBase):
         '''
         return self.new_request(outcome_opts).post_replace_result(score, result_data)
 
-    def post_delete_result(self, outcome_opts=defaultdict(lambda: None)):
+    def post_delete_result(self, outcome_opts=None):
         '''
         POSTs a delete request to the Tool Consumer.
         '''
         return self.new_request(outcome_opts).post_delete_result()
 
-    def post_read_result(self, outcome_opts=defaultdict(lambda: None)):
+    def post_read_result(self, outcome_opts=None):
         '''
         POSTs the given score to the Tool Consumer with a readResult. The
         returned OutcomeResponse will have the score.
@@ -157,8 +156,8 @@ class ToolProvider(ToolBase):
         return all((self._last_outcome_request,
                     self._last_outcome_request.was_outcome_post_successful()))
 
-    def new_request(self, defaults):
-        opts = dict(defaults)
+    def new_request(self, defaults=None):
+        opts = dict(defaults or {})
         opts.update({
             'consumer_key': self.consumer_key,
             'consumer_secret': self.consumer_secret,
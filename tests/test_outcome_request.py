@@ -1,6 +1,11 @@
 from lti.outcome_request import REPLACE_REQUEST
 from lti import OutcomeRequest, OutcomeResponse, InvalidLTIConfigError
 
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+import mock
+import requests
+import threading
 import unittest
 from oauthlib.common import unquote
 from httmock import all_requests, HTTMock
@@ -39,6 +44,28 @@ REPLACE_RESULT_XML = EXPECTED_XML[:] % b'''
 </replaceResultRequest>
 '''
 
+REPLACE_RESULT_DATA_XML = EXPECTED_XML[:] % b'''
+<replaceResultRequest>
+    <resultRecord>
+        <sourcedGUID>
+            <sourcedId>261-154-728-17-784</sourcedId>
+        </sourcedGUID>
+        <result>
+            <resultScore>
+                <language>en</language>
+                <textString>5</textString>
+            </resultScore>
+            <resultData>
+                <text>Well done</text>
+            </resultData>
+        </result>
+    </resultRecord>
+    <submissionDetails>
+        <needsAdditionalReview/>
+    </submissionDetails>
+</replaceResultRequest>
+'''
+
 READ_RESULT_XML = EXPECTED_XML[:] % b'''
 <readResultRequest>
     <resultRecord>
@@ -59,11 +86,37 @@ DELETE_RESULT_XML = EXPECTED_XML[:] % b'''
 </deleteResultRequest>
 '''
 
+SUCCESS_RESPONSE_XML = b'''<?xml version="1.0" encoding="UTF-8"?>
+<imsx_POXEnvelopeResponse xmlns="http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0">
+    <imsx_POXHeader>
+        <imsx_POXResponseHeaderInfo>
+            <imsx_version>V1.0</imsx_version>
+            <imsx_messageIdentifier>4560</imsx_messageIdentifier>
+            <imsx_statusInfo>
+                <imsx_codeMajor>success</imsx_codeMajor>
+                <imsx_severity>status</imsx_severity>
+                <imsx_description>Score for foo is now 5</imsx_description>
+                <imsx_messageRefIdentifier>123456789</imsx_messageRefIdentifier>
+                <imsx_operationRefIdentifier>replaceResult</imsx_operationRefIdentifier>
+            </imsx_statusInfo>
+        </imsx_POXResponseHeaderInfo>
+    </imsx_POXHeader>
+    <imsx_POXBody>
+        <replaceResultResponse/>
+    </imsx_POXBody>
+</imsx_POXEnvelopeResponse>
+'''
+
 @all_requests
 def response_content(url, request):
     return {'status_code': 200,
             'content': 'Oh hai'}
 
+@all_requests
+def success_response_content(url, request):
+    return {'status_code': 200,
+            'content': SUCCESS_RESPONSE_XML}
+
 class TestOutcomeRequest(unittest.TestCase):
 
     def test_parse_replace_result_xml(self):
@@ -77,6 +130,52 @@ class TestOutcomeRequest(unittest.TestCase):
         self.assertEqual(request.message_identifier, '123456789')
         self.assertEqual(request.score, '5')
 
+    def test_parse_replace_result_data_xml(self):
+        '''
+        Should parse resultData and needsAdditionalReview from replaceResult
+        XML.
+        '''
+        request = OutcomeRequest()
+        request.process_xml(REPLACE_RESULT_DATA_XML)
+        self.assertEqual(request.operation, 'replaceResult')
+        self.assertEqual(request.lis_result_sourcedid, '261-154-728-17-784')
+        self.assertEqual(request.score, '5')
+        self.assertEqual(request.result_data, {'text': 'Well done'})
+        self.assertTrue(request.needs_additional_review)
+
+        request = OutcomeRequest()
+        request.process_xml(REPLACE_RESULT_XML)
+        self.assertEqual(request.result_data, None)
+        self.assertFalse(request.needs_additional_review)
+
+    def test_parse_result_data_only_from_result(self):
+        '''
+        Should ignore text/url elements outside of resultData.
+        '''
+        xml = REPLACE_RESULT_XML.replace(
+            b'</resultRecord>',
+            b'</resultRecord><ext><url>evil</url><text>evil</text></ext>')
+        request = OutcomeRequest()
+        request.process_xml(xml)
+        self.assertEqual(request.result_data, None)
+
+        xml = REPLACE_RESULT_DATA_XML.replace(
+            b'</replaceResultRequest>',
+            b'<ext><url>evil</url></ext></replaceResultRequest>')
+        request = OutcomeRequest()
+        request.process_xml(xml)
+        self.assertEqual(request.result_data, {'text': 'Well done'})
+
+    def test_parse_xml_from_file(self):
+        '''
+        Should parse XML from a file-like object.
+        '''
+        request = OutcomeRequest()
+        request.process_xml(BytesIO(REPLACE_RESULT_XML))
+        self.assertEqual(request.operation, 'replaceResult')
+        self.assertEqual(request.lis_result_sourcedid, '261-154-728-17-784')
+        self.assertEqual(request.score, '5')
+
     def test_parse_read_result_xml(self):
         '''
         Should parse readResult XML.
@@ -99,6 +198,130 @@ class TestOutcomeRequest(unittest.TestCase):
         self.assertEqual(request.message_identifier, '123456789')
         self.assertEqual(request.score, None)
 
+    def test_generate_request_xml_round_trip(self):
+        '''
+        Should generate XML that parses back to the same request.
+        '''
+        request = OutcomeRequest()
+        request.operation = REPLACE_REQUEST
+        request.message_identifier = '123456789'
+        request.lis_result_sourcedid = '261-154-728-17-784'
+        request.score = 0.5
+        request.result_data = {'url': 'http://example.edu/?a=1&b=<2>'}
+        request.needs_additional_review = True
+        parsed = OutcomeRequest()
+        parsed.process_xml(request.generate_request_xml())
+        self.assertEqual(parsed.operation, 'replaceResult')
+        self.assertEqual(parsed.message_identifier, '123456789')
+        self.assertEqual(parsed.lis_result_sourcedid, '261-154-728-17-784')
+        self.assertEqual(parsed.score, '0.5')
+        self.assertEqual(parsed.result_data,
+                         {'url': 'http://example.edu/?a=1&b=<2>'})
+        self.assertTrue(parsed.needs_additional_review)
+
+    def test_parse_xml_does_not_resolve_entities(self):
+        '''
+        Should not expand external entities declared in the XML.
+        '''
+        xml = REPLACE_RESULT_XML.replace(
+            b'?>',
+            b'?><!DOCTYPE x [<!ENTITY e SYSTEM "file:///etc/passwd">]>', 1
+        ).replace(b'123456789', b'&e;')
+        request = OutcomeRequest()
+        request.process_xml(xml)
+        self.assertEqual(request.message_identifier, '')
+        self.assertEqual(request.score, '5')
+
+    def test_constructor(self):
+        request = OutcomeRequest({'consumer_key': 'foo', 'score': 1})
+        self.assertEqual(request.consumer_key, 'foo')
+        self.assertEqual(request.score, 1)
+        self.assertEqual(request.operation, None)
+        self.assertRaises(InvalidLTIConfigError, OutcomeRequest,
+                          {'consumer_key': 'foo', 'bogus': 'bar'})
+
+    def test_default_headers(self):
+        request = OutcomeRequest()
+        self.assertEqual(request.headers['content-type'], 'application/xml')
+        request.headers['Content-Type'] = 'text/xml'
+        self.assertEqual(OutcomeRequest().headers['Content-Type'],
+                         'application/xml')
+        request = OutcomeRequest(headers={'content-type': 'text/xml'})
+        self.assertEqual(request.headers['Content-Type'], 'text/xml')
+
+    def test_generate_request_xml_rejects_invalid_characters(self):
+        '''
+        Should refuse to generate XML containing control characters.
+        '''
+        for value in ('a\x01b', 'a\x00b', 'a\ufffeb'):
+            request = OutcomeRequest()
+            request.operation = REPLACE_REQUEST
+            request.lis_result_sourcedid = value
+            self.assertRaises(ValueError, request.generate_request_xml)
+        request.lis_result_sourcedid = 'a\tb\nc'
+        self.assertIn(b'a\tb\nc', request.generate_request_xml())
+
+    def test_generate_request_xml_accepts_ascii_bytes(self):
+        '''
+        Should accept ASCII bytes values, as lxml does.
+        '''
+        request = OutcomeRequest()
+        request.operation = REPLACE_REQUEST
+        request.lis_result_sourcedid = b'a&b'
+        self.assertIn(b'<sourcedId>a&amp;b</sourcedId>',
+                      request.generate_request_xml())
+        for value in (b'caf\xc3\xa9', b'a\x01b'):
+            request.lis_result_sourcedid = value
+            self.assertRaises(ValueError, request.generate_request_xml)
+
+    def test_generate_read_request_xml(self):
+        '''
+        Should only identify the result in readResult XML.
+        '''
+        request = OutcomeRequest()
+        request.operation = 'readResult'
+        request.lis_result_sourcedid = '261-154-728-17-784'
+        request.score = 5
+        request.needs_additional_review = True
+        xml = request.generate_request_xml()
+        self.assertIn(b'<readResultRequest><resultRecord><sourcedGUID>'
+                      b'<sourcedId>261-154-728-17-784</sourcedId>'
+                      b'</sourcedGUID></resultRecord></readResultRequest>',
+                      xml)
+        self.assertNotIn(b'resultScore', xml)
+
+    def test_generate_request_xml_without_declaration(self):
+        request = OutcomeRequest()
+        request.operation = 'deleteResult'
+        request.lis_result_sourcedid = 'foo'
+        self.assertTrue(request.generate_request_xml().startswith(b'<?xml'))
+        request.xml_declaration = False
+        self.assertTrue(request.generate_request_xml().startswith(
+            b'<imsx_POXEnvelopeRequest '))
+
+        request = OutcomeRequest()
+        request.operation = 'deleteResult'
+        request.lis_result_sourcedid = 'foo'
+        self.assertTrue(request.generate_request_xml().startswith(b'<?xml'))
+        with mock.patch.object(OutcomeRequest, 'xml_declaration', False):
+            self.assertTrue(request.generate_request_xml().startswith(
+                b'<imsx_POXEnvelopeRequest '))
+
+    def test_generate_request_xml_is_cached(self):
+        request = OutcomeRequest()
+        request.operation = REPLACE_REQUEST
+        request.lis_result_sourcedid = 'foo'
+        request.score = 1
+        xml = request.generate_request_xml()
+        with mock.patch.object(request, '_render_request_xml') as render:
+            self.assertEqual(request.generate_request_xml(), xml)
+            request.consumer_key = 'consumer'
+            self.assertEqual(request.generate_request_xml(), xml)
+        self.assertFalse(render.called)
+        request.score = 2
+        self.assertIn(b'<textString>2</textString>',
+                      request.generate_request_xml())
+
     def test_has_required_attributes(self):
         request = OutcomeRequest()
         self.assertFalse(request.has_required_attributes())
@@ -138,6 +361,139 @@ class TestOutcomeRequest(unittest.TestCase):
             'oauth_signature="XR6A1CmUauXZdJZXa1pJpTQi6OQ="')
         self.assertEqual(auth_header, correct)
 
+    def test_post_outcome_request_signs_each_request(self):
+        '''
+        Should produce a fresh nonce for each request with the same
+        credentials.
+        '''
+        opts = {
+            'consumer_key': 'consumer',
+            'consumer_secret': 'secret',
+            'lis_outcome_service_url': 'http://example.edu/',
+            'lis_result_sourcedid': 'foo',
+            'operation': REPLACE_REQUEST,
+        }
+        nonces = set()
+        with HTTMock(response_content):
+            for _ in range(2):
+                resp = OutcomeRequest(opts).post_outcome_request()
+                auth_header = resp.post_response.request.headers[
+                    'authorization'].decode('utf-8')
+                nonces.add(auth_header.split('oauth_nonce="')[1].split('"')[0])
+        self.assertEqual(len(nonces), 2)
+
+    def test_post_replace_result(self):
+        request = OutcomeRequest({
+            'consumer_key': 'consumer',
+            'consumer_secret': 'secret',
+            'lis_outcome_service_url': 'http://example.edu/',
+            'lis_result_sourcedid': 'foo',
+        })
+        with HTTMock(success_response_content):
+            resp = request.post_replace_result(5)
+        self.assertTrue(request.was_outcome_post_successful())
+        self.assertEqual(resp.message_identifier, '4560')
+        self.assertEqual(resp.message_ref_identifier, '123456789')
+        self.assertEqual(resp.description, 'Score for foo is now 5')
+
+    def test_post_replace_result_validates_result_data(self):
+        request = OutcomeRequest({
+            'consumer_key': 'consumer',
+            'consumer_secret': 'secret',
+            'lis_outcome_service_url': 'http://example.edu/',
+            'lis_result_sourcedid': 'foo',
+        })
+        self.assertRaises(InvalidLTIConfigError, request.post_replace_result,
+                          5, {'text': 'a', 'url': 'http://example.edu/'})
+        self.assertRaises(InvalidLTIConfigError, request.post_replace_result,
+                          5, {'html': 'a'})
+        with HTTMock(success_response_content):
+            request.post_replace_result(5, {'ltiLaunchUrl': 'http://a.b/'})
+        self.assertTrue(request.was_outcome_post_successful())
+
+    def post_to_server(self, status, body, content_length=None):
+        '''
+        POST a replaceResult to a local HTTP server that answers once with
+        the given status and body.
+        '''
+        if content_length is None:
+            content_length = len(body)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/html')
+                self.send_header('Content-Length', str(content_length))
+                self.end_headers()
+                self.wfile.write(body)
+                self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        try:
+            request = OutcomeRequest({
+                'consumer_key': 'consumer',
+                'consumer_secret': 'secret',
+                'lis_outcome_service_url':
+                    'http://127.0.0.1:%d/' % server.server_port,
+                'lis_result_sourcedid': 'foo',
+            })
+            request.session = requests.Session()
+            return request, request.post_replace_result(5)
+        finally:
+            thread.join()
+            server.server_close()
+
+    def test_post_outcome_request_keeps_response_body(self):
+        '''
+        Should keep the Tool Consumer's response body.
+        '''
+        page = b'<html><body><p>Internal Server Error</body></html>'
+        request, resp = self.post_to_server(500, page)
+        self.assertEqual(resp.response_code, 500)
+        self.assertFalse(request.was_outcome_post_successful())
+        self.assertEqual(resp.post_response.content, page)
+        self.assertIn('Internal Server Error', resp.post_response.text)
+
+    def test_post_outcome_request_raises_requests_errors(self):
+        '''
+        Should raise a requests exception when the response is cut short.
+        '''
+        self.assertRaises(requests.RequestException, self.post_to_server,
+                          200, SUCCESS_RESPONSE_XML[:129], content_length=5000)
+
+    def test_post_batch(self):
+        opts = {
+            'consumer_key': 'consumer',
+            'consumer_secret': 'secret',
+            'lis_outcome_service_url': 'http://example.edu/',
+            'operation': REPLACE_REQUEST,
+        }
+        outcome_requests = []
+        for i in range(5):
+            request = OutcomeRequest(dict(opts, lis_result_sourcedid=str(i),
+                                          score=i))
+            outcome_requests.append(request)
+        with HTTMock(response_content):
+            responses = OutcomeRequest.post_batch(outcome_requests, max_workers=2)
+        self.assertEqual(len(responses), 5)
+        for request, response in zip(outcome_requests, responses):
+            self.assertIsInstance(response, OutcomeResponse)
+            self.assertIs(request.outcome_response, response)
+            self.assertIn(('<sourcedId>%s</sourcedId>' %
+                           request.lis_result_sourcedid).encode('utf-8'),
+                          response.post_response.request.body)
+
+    def test_post_batch_reraises(self):
+        request = OutcomeRequest()
+        self.assertRaises(InvalidLTIConfigError, OutcomeRequest.post_batch,
+                          [request])
+
     def test_from_post_request(self):
         factory = RequestFactory()
         post_request = factory.post('/',
@@ -152,3 +508,20 @@ class TestOutcomeRequest(unittest.TestCase):
         self.assertEqual(request.score, '5')
         self.assertEqual(request.headers.get('User-Agent'), "post-request")
         self.assertEqual(request.headers.get('Content-Type'), "text/xml")
+        # The body must still be readable, e.g. to check the OAuth body hash
+        self.assertEqual(post_request.body, REPLACE_RESULT_XML)
+
+    def test_post_outcome_request_uses_session(self):
+        request = OutcomeRequest()
+        request.consumer_key = 'consumer'
+        request.consumer_secret = 'secret'
+        request.lis_outcome_service_url = 'http://example.edu/'
+        request.lis_result_sourcedid = 'foo'
+        request.operation = REPLACE_REQUEST
+        self.assertIs(request.session, OutcomeRequest.session)
+        request.session = requests.Session()
+        with HTTMock(response_content):
+            with mock.patch.object(request.session, 'post',
+                                   wraps=request.session.post) as post:
+                request.post_outcome_request()
+        self.assertEqual(post.call_count, 1)
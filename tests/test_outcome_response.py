@@ -1,4 +1,8 @@
-from lti import OutcomeResponse
+from lti import OutcomeResponse, InvalidLTIConfigError
+from io import BytesIO
+import gzip
+import requests
+import urllib3
 from lxml import etree
 import mock
 import unittest
@@ -37,6 +41,14 @@ class TestOutcomeResponse(unittest.TestCase):
         resp.data = response_xml
         return resp
 
+    def test_constructor(self):
+        response = OutcomeResponse(code_major='success', score='1')
+        self.assertTrue(response.is_success())
+        self.assertEqual(response.score, '1')
+        self.assertEqual(response.severity, None)
+        self.assertRaises(InvalidLTIConfigError, OutcomeResponse,
+                          code_major='success', bogus='foo')
+
     def test_parse_replace_result_response_xml(self):
         '''
         Should parse replaceResult response XML.
@@ -98,6 +110,80 @@ class TestOutcomeResponse(unittest.TestCase):
         result = OutcomeResponse.from_post_response(fake, failure_xml)
         self.assertTrue(result.is_failure())
 
+    def test_parse_response_from_stream(self):
+        '''
+        Should parse response XML from a streamed response body.
+        '''
+        read_xml = RESPONSE_XML.replace(
+                b'<replaceResultResponse/>',
+                b'''<readResultResponse>
+<result>
+<resultScore>
+<language>en</language>
+<textString>0.91</textString>
+</resultScore>
+</result>
+</readResultResponse>''').replace(b'replaceResult', b'readResult')
+        response = OutcomeResponse.from_stream(
+            self.streamed_response(read_xml))
+        self.assertEqual(response.response_code, 200)
+        self.assertTrue(response.is_success())
+        self.assertEqual(response.message_ref_identifier, '123456789')
+        self.assertEqual(response.operation, 'readResult')
+        self.assertEqual(response.score, '0.91')
+
+    def streamed_response(self, body, status_code=200, headers=None):
+        raw = urllib3.HTTPResponse(body=BytesIO(body), headers=headers,
+                                   status=status_code,
+                                   preload_content=False)
+        resp = requests.Response()
+        resp.status_code = status_code
+        resp.headers = requests.structures.CaseInsensitiveDict(headers or {})
+        resp.raw = raw
+        return resp
+
+    def test_from_stream(self):
+        '''
+        Should parse a streamed, content-encoded body.
+        '''
+        resp = self.streamed_response(
+            gzip.compress(RESPONSE_XML), headers={'Content-Encoding': 'gzip'})
+        response = OutcomeResponse.from_stream(resp)
+        self.assertTrue(response.is_success())
+        self.assertEqual(response.message_ref_identifier, '123456789')
+        self.assertEqual(response.operation, 'replaceResult')
+
+    def test_from_stream_ignores_error_page(self):
+        '''
+        Should leave the response unset for a streamed non-XML body.
+        '''
+        page = (b'<html><body><p>Internal Server Error</body></html>' +
+                b' ' * 70000)
+        resp = self.streamed_response(page, status_code=500)
+        response = OutcomeResponse.from_stream(resp)
+        self.assertEqual(response.response_code, 500)
+        self.assertEqual(response.code_major, None)
+
+    def test_from_stream_raises_requests_errors(self):
+        '''
+        Should raise a requests exception when the body is cut short.
+        '''
+        resp = self.streamed_response(
+            RESPONSE_XML[:100],
+            headers={'Content-Length': str(len(RESPONSE_XML))})
+        self.assertRaises(requests.exceptions.ChunkedEncodingError,
+                          OutcomeResponse.from_stream, resp)
+
+    def test_ignore_non_xml_response(self):
+        '''
+        Should leave the response unset when the body isn't XML.
+        '''
+        fake = self.mock_response(b'<html>Oops')
+        result = OutcomeResponse.from_post_response(fake, b'<html>Oops')
+        self.assertEqual(result.response_code, '200')
+        self.assertEqual(result.code_major, None)
+        self.assertFalse(result.is_success())
+
     def test_generate_response_xml(self):
         '''
         Should generate response XML.